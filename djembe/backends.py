@@ -1,7 +1,10 @@
+import copy
 import email
+import hashlib
 import logging
 import smtplib
 import sys
+import time
 
 from django.conf import settings
 from django.core.mail.backends import base
@@ -13,15 +16,51 @@ from M2Crypto import BIO
 from M2Crypto import SMIME
 from M2Crypto import X509
 
+from djembe import background
+from djembe import profiling
+from djembe import ratelimit
+from djembe import snapshot
+from djembe import tls
 from djembe.models import Identity
+from djembe.models import get_read_database
+
+
+class BackgroundEncryptingBackend(base.BaseEmailBackend):
+    """
+    Queues messages for worker threads to sign, encrypt and deliver, instead
+    of making the caller wait. See djembe.background for the settings.
+
+    Messages must not be changed after they're sent, since they may still be
+    waiting in the queue.
+    """
+
+    def send_messages(self, email_messages):
+        """
+        Queues one or more EmailMessage objects and returns the number of
+        email messages queued.
+        """
+        if not email_messages:
+            return 0
+
+        pool = background.get_pool()
+        num_queued = 0
+        for message in email_messages:
+            try:
+                if pool.put(message, self.fail_silently):
+                    num_queued += 1
+            except background.QueueFull:
+                if self.fail_silently is False:
+                    raise
+        return num_queued
 
 
 class EncryptingBackendMixin(object):
     """
     A mixin to encrypt, possibly sign, and finally deliver messages.
 
-    Backends built with this should implement deliver(), and call send() for
-    each message in send_messages().
+    Backends built with this should implement deliver(). The send_messages()
+    here calls send() for each message; backends that manage a connection
+    should override it to do so around the same loop.
     """
     logger = logging.getLogger('djembe.backends.EncryptingBackendMixin')
 
@@ -31,11 +70,14 @@ class EncryptingBackendMixin(object):
         'Mime-Version',
     ]
 
+    # certificate -> fingerprint, shared by all instances
+    fingerprints = {}
+
     def analyze_recipients(self, email_message):
         """
         Determine which recipients should get encrypted messages.
         """
-        encrypting_identities = plaintext_recipients = None
+        encrypting_identities = encrypting_recipients = plaintext_recipients = None
 
         if email_message.recipients():
             recipients = set([
@@ -43,7 +85,7 @@ class EncryptingBackendMixin(object):
                 for addr in email_message.recipients()
             ])
 
-            encrypting_identities = Identity.objects.filter(address__in=recipients)
+            encrypting_identities = self.get_encrypting_identities(recipients)
             encrypting_recipients = set([r.address for r in encrypting_identities])
             plaintext_recipients = recipients - encrypting_recipients
 
@@ -55,6 +97,15 @@ class EncryptingBackendMixin(object):
         """
         raise NotImplementedError
 
+    def deliver_encrypted(self, sender_address, recipients, encrypted_message):
+        """
+        Delivers an encrypted message.
+
+        Backends that can transfer it more efficiently than as text can
+        override this.
+        """
+        self.deliver(sender_address, recipients, encrypted_message.as_string())
+
     def encrypt(self, sender_address, encrypting_identities, message):
         """
         Encrypts the given message for all the supplied recipients.
@@ -73,9 +124,10 @@ class EncryptingBackendMixin(object):
 
         self.logger.debug("Encrypting message for %s" % encrypting_identities)
 
-        # Gather all the recipient certificates
+        # Gather the recipient certificates
+        certificate_identities = self.unique_certificates(encrypting_identities)
         sk = X509.X509_Stack()
-        for identity in encrypting_identities:
+        for identity in certificate_identities:
             sk.push(identity.x509)
         s.set_x509_stack(sk)
 
@@ -83,6 +135,7 @@ class EncryptingBackendMixin(object):
         payload_msg = self.extract_payload(message)
 
         # encrypt the payload
+        started = time.time()
         payload = BIO.MemoryBuffer(payload_msg.as_string())
         pkcs7_encrypted_data = s.encrypt(payload)
         payload.close()
@@ -93,13 +146,15 @@ class EncryptingBackendMixin(object):
         pkcs7_string = payload.read()
         payload.close()
 
-        encrypted_message = email.message_from_string(pkcs7_string)
+        self.logger.debug("Encrypted for %d certificates: %d bytes in %.3fs" % (
+            len(certificate_identities),
+            len(pkcs7_string),
+            time.time() - started
+        ))
 
-        message.set_payload(encrypted_message.get_payload())
+        encrypted_message = email.message_from_string(pkcs7_string)
 
-        for header, value in encrypted_message.items():
-            del message[header]
-            message[header] = value
+        self.replace_payload(message, encrypted_message)
         del message['Message-ID']
         message['Message-ID'] = make_msgid()
 
@@ -112,16 +167,52 @@ class EncryptingBackendMixin(object):
             payload_msg[header] = message[header]
         return payload_msg
 
+    def get_encrypting_identities(self, addresses):
+        """
+        Returns all identities for the given recipient addresses.
+        """
+        identity_snapshot = self.get_identity_snapshot()
+        if identity_snapshot is not None:
+            return identity_snapshot.filter(addresses)
+        return Identity.objects.using(get_read_database()).filter(address__in=addresses)
+
+    def get_fingerprint(self, identity):
+        """
+        Returns the fingerprint of an identity's certificate, parsing each
+        certificate only once per process.
+        """
+        certificate = str(identity.certificate)
+        fingerprint = self.fingerprints.get(certificate)
+        if fingerprint is None:
+            fingerprint = self.fingerprints[certificate] = identity.fingerprint
+        return fingerprint
+
+    def get_identity_snapshot(self):
+        """
+        Returns the snapshot named by settings.DJEMBE_IDENTITY_SNAPSHOT, if any.
+        """
+        path = getattr(settings, 'DJEMBE_IDENTITY_SNAPSHOT', None)
+        if path:
+            return snapshot.get_snapshot(path)
+        return None
+
+    def get_signing_identities(self, address):
+        """
+        Returns the identities for the given sender address that have a key.
+        """
+        identity_snapshot = self.get_identity_snapshot()
+        if identity_snapshot is not None:
+            return identity_snapshot.signing_identities(address)
+        return Identity.objects.using(get_read_database()).filter(address=address).exclude(key='')
+
     def get_sender_identity(self, address):
         """
         Looks for an Identity matching the sender address.
         """
         sender_identity = None
         if address:
-            sender_identities = Identity.objects.filter(
-                address=address,
-            ).exclude(key='')
-            sender_count = sender_identities.count()
+            sender_identities = list(self.get_signing_identities(address))
+            sender_count = len(sender_identities)
             if sender_count > 0:
                 if sender_count == 1:
                     sender_identity = sender_identities[0]
@@ -132,6 +223,16 @@ class EncryptingBackendMixin(object):
 
         return sender_identity
 
+    def replace_payload(self, message, new_message):
+        """
+        Replaces the payload of message, and the headers describing it, with
+        those of new_message.
+        """
+        message.set_payload(new_message.get_payload())
+        for header, value in new_message.items():
+            del message[header]
+            message[header] = value
+
     def send(self, email_message):
         """
         Sends a message, possibly signed, possibly encrypted.
@@ -140,6 +241,25 @@ class EncryptingBackendMixin(object):
 
         Recipients for whom an Identity can be found will be sent an encrypted
         version, any others get plaintext.
+
+        The settings described in djembe.profiling can have this profiled.
+        """
+        capture = profiling.start_capture()
+        if capture is None:
+            return self._send(email_message)
+
+        error = None
+        try:
+            return self._send(email_message, capture.metadata)
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            capture.finish(error, email_message)
+
+    def _send(self, email_message, shape=None):
+        """
+        Does the work of send(), describing how it was sent in shape if given.
         """
         sender_address = sanitize_address(
             email_message.from_email,
@@ -152,6 +272,21 @@ class EncryptingBackendMixin(object):
         # work with the regular standard library message instead of Django's wrapper
         message = email_message.message()
 
+        if encrypting_identities:
+            envelopes = self.split_envelopes(encrypting_identities, encrypting_recipients)
+        else:
+            envelopes = []
+
+        if shape is not None:
+            shape.update({
+                'cipher': getattr(settings, 'DJEMBE_CIPHER', 'aes_256_cbc'),
+                'encrypted_envelopes': len(envelopes),
+                'encrypting_identities': len(encrypting_identities or []),
+                'encrypting_recipients': len(encrypting_recipients or []),
+                'plaintext_recipients': len(plaintext_recipients or []),
+                'signer': sender_identity.fingerprint if sender_identity else None,
+            })
+
         if sender_identity:
             message = self.sign(sender_identity, message)
 
@@ -168,18 +303,18 @@ class EncryptingBackendMixin(object):
                 if self.fail_silently is False:
                     raise
 
-        if encrypting_identities:
+        for envelope_identities, envelope_recipients in envelopes:
             try:
                 encrypted_message = self.encrypt(
                     sender_address,
-                    encrypting_identities,
-                    message
+                    envelope_identities,
+                    copy.deepcopy(message) if len(envelopes) > 1 else message
                 )
 
-                self.deliver(
+                self.deliver_encrypted(
                     sender_address,
-                    encrypting_recipients,
-                    encrypted_message.as_string()
+                    envelope_recipients,
+                    encrypted_message
                 )
                 sent += 1
             except:
@@ -193,6 +328,53 @@ class EncryptingBackendMixin(object):
 
         return sent
 
+    def split_envelopes(self, encrypting_identities, encrypting_recipients):
+        """
+        Divides the encrypting recipients into groups of at most
+        settings.DJEMBE_MAX_RECIPIENTS_PER_ENVELOPE addresses, each to get its
+        own encrypted copy of the message.
+
+        Returns a list of (identities, recipients) pairs.
+        """
+        max_recipients = getattr(settings, 'DJEMBE_MAX_RECIPIENTS_PER_ENVELOPE', None)
+        if not max_recipients or len(encrypting_recipients) <= max_recipients:
+            return [(encrypting_identities, encrypting_recipients)]
+
+        addresses = sorted(encrypting_recipients)
+        envelopes = []
+        for i in range(0, len(addresses), max_recipients):
+            recipients = set(addresses[i:i + max_recipients])
+            identities = [identity for identity in encrypting_identities if identity.address in recipients]
+            envelopes.append((identities, recipients))
+        return envelopes
+
+    def send_messages(self, email_messages):
+        if not email_messages:
+            return 0
+
+        num_sent = 0
+        for message in email_messages:
+            num_sent += self.send(message)
+
+        return num_sent
+
+    def unique_certificates(self, identities):
+        """
+        Returns the first of the given identities for each distinct
+        certificate, in order.
+
+        The same certificate may be on file for several addresses, but a
+        message needs to be encrypted for it only once.
+        """
+        fingerprints = set()
+        unique = []
+        for identity in identities:
+            fingerprint = self.get_fingerprint(identity)
+            if fingerprint not in fingerprints:
+                fingerprints.add(fingerprint)
+                unique.append(identity)
+        return unique
+
     def sign(self, sender_identity, message):
         """
         Signs an email message.
@@ -230,11 +412,88 @@ class EncryptingBackendMixin(object):
 
         signed_message = email.message_from_string(pkcs7_string)
 
-        message.set_payload(signed_message.get_payload())
+        self.replace_payload(message, signed_message)
 
-        for header, value in signed_message.items():
-            del message[header]
-            message[header] = value
+        return message
+
+
+class FakeCryptoBackendMixin(EncryptingBackendMixin):
+    """
+    Decides who gets signed and encrypted mail just like
+    EncryptingBackendMixin, but instead of doing any cryptography wraps
+    messages in cheap, deterministic envelopes that tests can inspect with
+    djembe.testing.parse_envelope().
+    """
+
+    encrypted_content_type = 'application/x-djembe-fake-pkcs7-mime'
+    signature_content_type = 'application/x-djembe-fake-signature'
+
+    def encrypt(self, sender_address, encrypting_identities, message):
+        """
+        Wraps the message in an envelope listing its recipients' fingerprints.
+        """
+
+        if not encrypting_identities:
+            raise ValueError('Encrypting recipient identities not supplied.')
+
+        if not message:
+            raise ValueError('Valid Message not supplied.')
+
+        cipher = getattr(settings, 'DJEMBE_CIPHER', 'aes_256_cbc')
+
+        self.logger.debug("Fake encrypting message for %s" % encrypting_identities)
+
+        lines = ['X-Djembe-Cipher: %s' % cipher]
+        for identity in self.unique_certificates(encrypting_identities):
+            lines.append('X-Djembe-Recipient: %s' % self.get_fingerprint(identity))
+        lines.append(self.extract_payload(message).as_string())
+
+        encrypted_message = email.message.Message()
+        encrypted_message['MIME-Version'] = '1.0'
+        encrypted_message['Content-Disposition'] = 'attachment; filename="smime.p7m"'
+        encrypted_message['Content-Type'] = '%s; smime-type=enveloped-data; name="smime.p7m"' % self.encrypted_content_type
+        encrypted_message['Content-Transfer-Encoding'] = '8bit'
+        encrypted_message.set_payload('\n'.join(lines))
+
+        self.replace_payload(message, encrypted_message)
+        del message['Message-ID']
+        message['Message-ID'] = make_msgid()
+
+        return message
+
+    def sign(self, sender_identity, message):
+        """
+        Wraps the message in a multipart/signed whose signature part names the
+        signer.
+        """
+
+        self.logger.debug('Fake signing message as %s' % sender_identity)
+
+        content = self.extract_payload(message).as_string()
+        boundary = 'djembe-fake-signature-%s' % hashlib.sha1(content).hexdigest()[:16]
+
+        signed_message = email.message_from_string('\n'.join([
+            'MIME-Version: 1.0',
+            'Content-Type: multipart/signed; protocol="%s"; micalg="sha1"; boundary="%s"' % (
+                self.signature_content_type,
+                boundary
+            ),
+            '',
+            'This is a fake S/MIME signed message',
+            '',
+            '--%s' % boundary,
+            content,
+            '--%s' % boundary,
+            'Content-Type: %s' % self.signature_content_type,
+            '',
+            'Signer: %s' % sender_identity.address,
+            'Fingerprint: %s' % self.get_fingerprint(sender_identity),
+            '',
+            '--%s--' % boundary,
+            '',
+        ]))
+
+        self.replace_payload(message, signed_message)
 
         return message
 
@@ -244,10 +503,45 @@ class EncryptingSMTPBackend(EncryptingBackendMixin, smtp.EmailBackend):
     Delivers encrypted messages via SMTP.
     """
 
+    bdat_chunk_size = 64 * 1024
+
+    def binary_message(self, message):
+        """
+        Returns the message as a string with CRLF-terminated headers and its
+        base64 payload decoded to binary, for BINARYMIME transfer.
+        """
+        header_message = email.message.Message()
+        for header, value in message.items():
+            header_message[header] = value
+        header_message.replace_header('Content-Transfer-Encoding', 'binary')
+        headers = header_message.as_string().replace('\r\n', '\n').rstrip('\n')
+        return headers.replace('\n', '\r\n') + '\r\n\r\n' + message.get_payload(decode=True)
+
+    def binary_transfer_available(self):
+        """
+        Whether settings.DJEMBE_BINARY_TRANSFER is set and the relay supports
+        the CHUNKING and BINARYMIME extensions.
+        """
+        if not getattr(settings, 'DJEMBE_BINARY_TRANSFER', False) or self.connection is None:
+            return False
+        self.connection.ehlo_or_helo_if_needed()
+        return self.connection.has_extn('chunking') and self.connection.has_extn('binarymime')
+
+    @property
+    def connection_class(self):
+        """
+        With settings.DJEMBE_TLS_SESSION_CACHE set, TLS connections are made
+        with djembe.tls, which resumes the relay's last session.
+        """
+        if getattr(settings, 'DJEMBE_TLS_SESSION_CACHE', False) and (self.use_ssl or self.use_tls):
+            return tls.SMTP_SSL if self.use_ssl else tls.SMTP
+        return super(EncryptingSMTPBackend, self).connection_class
+
     def deliver(self, sender_address, recipients, message):
         """
         Handles the actual delivery of a message.
         """
+        self.throttle(sender_address, recipients)
         self.logger.info("Delivering message from %s to %s" % (sender_address, recipients))
         return self.connection.sendmail(
             sender_address,
@@ -255,6 +549,78 @@ class EncryptingSMTPBackend(EncryptingBackendMixin, smtp.EmailBackend):
             message
         )
 
+    def deliver_binary(self, sender_address, recipients, message):
+        """
+        Delivers a binary message in BDAT chunks (RFC 3030).
+
+        Like smtplib's sendmail(), returns a dictionary of refused recipients
+        and raises if all of them were refused.
+        """
+        self.throttle(sender_address, recipients)
+        self.logger.info("Delivering binary message from %s to %s" % (sender_address, recipients))
+
+        connection = self.connection
+        code, response = connection.mail(sender_address, ['BODY=BINARYMIME'])
+        if code != 250:
+            connection.rset()
+            raise smtplib.SMTPSenderRefused(code, response, sender_address)
+
+        refused = {}
+        for recipient in recipients:
+            code, response = connection.rcpt(recipient)
+            if code not in (250, 251):
+                refused[recipient] = (code, response)
+        if len(refused) == len(recipients):
+            connection.rset()
+            raise smtplib.SMTPRecipientsRefused(refused)
+
+        size = self.bdat_chunk_size
+        for offset in range(0, len(message), size):
+            chunk = message[offset:offset + size]
+            last = offset + size >= len(message)
+            connection.send('BDAT %d%s\r\n' % (len(chunk), ' LAST' if last else ''))
+            connection.send(chunk)
+            code, response = connection.getreply()
+            if code != 250:
+                connection.rset()
+                raise smtplib.SMTPDataError(code, response)
+
+        return refused
+
+    def deliver_encrypted(self, sender_address, recipients, encrypted_message):
+        """
+        Delivers an encrypted message as binary DER when the relay allows it,
+        saving the base64 overhead and dot-stuffing, or as text otherwise.
+        """
+        if (
+            encrypted_message['Content-Transfer-Encoding'] == 'base64'
+            and self.binary_transfer_available()
+        ):
+            return self.deliver_binary(
+                sender_address,
+                recipients,
+                self.binary_message(encrypted_message)
+            )
+        return super(EncryptingSMTPBackend, self).deliver_encrypted(
+            sender_address,
+            recipients,
+            encrypted_message
+        )
+
+    def open(self):
+        """
+        Opens a connection like Django's SMTP backend, logging whether a TLS
+        session was resumed.
+        """
+        opened = super(EncryptingSMTPBackend, self).open()
+        if opened and getattr(self.connection, 'tls_connection', None) is not None:
+            self.logger.debug("TLS session with %s:%s %s" % (
+                self.host,
+                self.port,
+                'resumed' if self.tls_session_reused else 'negotiated'
+            ))
+        return opened
+
     def send_messages(self, email_messages):
         """
         Sends one or more EmailMessage objects and returns the number of email
@@ -276,6 +642,23 @@ class EncryptingSMTPBackend(EncryptingBackendMixin, smtp.EmailBackend):
             self._lock.release()
         return num_sent
 
+    def throttle(self, sender_address, recipients):
+        """
+        Waits for the rate limits in settings.DJEMBE_RATE_LIMITS, if any.
+        """
+        limiter = ratelimit.get_rate_limiter()
+        if limiter is not None:
+            wait = limiter.acquire('%s:%s' % (self.host, self.port), sender_address, recipients)
+            if wait:
+                self.logger.debug("Waited %.3fs for rate limits before delivering from %s" % (wait, sender_address))
+
+    @property
+    def tls_session_reused(self):
+        """
+        Whether the open connection resumed a TLS session.
+        """
+        return getattr(self.connection, 'tls_session_reused', False)
+
 
 class EncryptingTestBackend(EncryptingBackendMixin, base.BaseEmailBackend):
     """
@@ -300,12 +683,18 @@ class EncryptingTestBackend(EncryptingBackendMixin, base.BaseEmailBackend):
             'message': message
         })
 
-    def send_messages(self, email_messages):
-        if not email_messages:
-            return 0
 
-        num_sent = 0
-        for message in email_messages:
-            num_sent += self.send(message)
+class FakeCryptoTestBackend(FakeCryptoBackendMixin, base.BaseEmailBackend):
+    """
+    Collects fake-encrypted messages for review, for test suites that want to
+    check djembe's decisions without paying for real cryptography.
+    """
 
-        return num_sent
+    messages = []
+
+    def deliver(self, sender_address, recipients, message):
+        self.messages.append({
+            'sender': sender_address,
+            'recipients': recipients,
+            'message': message
+        })
@@ -0,0 +1,268 @@
+"""
+A bounded in-memory queue of outgoing messages, and the worker threads that
+sign, encrypt and deliver them, for djembe.backends.BackgroundEncryptingBackend.
+
+Messages still queued when the process exits are delivered first, for up to
+settings.DJEMBE_BACKGROUND_FLUSH_TIMEOUT seconds. Anything left after that,
+or lost to a crash, is gone: use a durable queue if that matters.
+"""
+import atexit
+import logging
+import os
+import smtplib
+import socket
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from django.conf import settings
+from django.core.mail import get_connection
+from django.db import close_old_connections
+
+
+logger = logging.getLogger('djembe.background')
+
+WHEN_FULL_CHOICES = ('block', 'drop', 'raise', 'send')
+
+_stop = object()
+
+
+class QueueFull(Exception):
+    """
+    Raised when a message can't be queued and DJEMBE_BACKGROUND_WHEN_FULL is
+    'raise', or 'block' and the wait timed out.
+    """
+
+
+class DeliveryPool(object):
+    """
+    Worker threads delivering queued messages, each through its own backend
+    instance, which keeps its connection open between messages.
+
+    A relay may close a connection that's been idle, so before each message
+    the connection is checked, and replaced if it's gone. A message isn't
+    retried once sending has started, since part of it may have been
+    delivered already.
+    """
+
+    def __init__(
+        self,
+        backend='djembe.backends.EncryptingSMTPBackend',
+        workers=2,
+        queue_size=1000,
+        when_full='block',
+        block_timeout=None
+    ):
+        if when_full not in WHEN_FULL_CHOICES:
+            raise ValueError('DJEMBE_BACKGROUND_WHEN_FULL must be one of %s.' % ', '.join(WHEN_FULL_CHOICES))
+        self.backend = backend
+        self.when_full = when_full
+        self.block_timeout = block_timeout
+        self.queue = queue.Queue(queue_size)
+        self.pid = os.getpid()
+
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.pending = 0
+        self.enqueued = 0
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.sent_directly = 0
+
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self.work, name='djembe-background-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def put(self, message, fail_silently=False):
+        """
+        Queues a message, returning whether it will be (or was) sent.
+
+        fail_silently applies if the message is sent in this thread because
+        the queue is full and DJEMBE_BACKGROUND_WHEN_FULL is 'send'.
+        """
+        with self.lock:
+            self.pending += 1
+        try:
+            if self.when_full == 'block':
+                self.queue.put(message, True, self.block_timeout)
+            else:
+                self.queue.put(message, False)
+        except queue.Full:
+            self.done()
+            if self.when_full == 'drop':
+                with self.lock:
+                    self.dropped += 1
+                logger.warning('Background mail queue is full; dropped a message.')
+                return False
+            if self.when_full == 'send':
+                connection = get_connection(self.backend, fail_silently=fail_silently)
+                sent = connection.send_messages([message])
+                with self.lock:
+                    self.sent_directly += 1
+                return bool(sent)
+            raise QueueFull('Background mail queue is full (%d messages).' % self.queue.maxsize)
+
+        with self.lock:
+            self.enqueued += 1
+        return True
+
+    def done(self):
+        with self.lock:
+            self.pending -= 1
+            if not self.pending:
+                self.idle.notify_all()
+
+    def deliver(self, backend, message):
+        """
+        Sends a message through a worker's backend, first reconnecting if the
+        relay has closed the connection.
+        """
+        connection = getattr(backend, 'connection', None)
+        if connection is not None and hasattr(connection, 'noop'):
+            try:
+                alive = connection.noop()[0] == 250
+            except (smtplib.SMTPException, socket.error):
+                alive = False
+            if not alive:
+                logger.info('Background mail connection lost; reconnecting.')
+                try:
+                    backend.close()
+                except Exception:
+                    # close() still forgets the connection
+                    pass
+        backend.open()
+        backend.send_messages([message])
+
+    def work(self):
+        backend = None
+        while True:
+            message = self.queue.get()
+            if message is _stop:
+                break
+            try:
+                if backend is None:
+                    backend = get_connection(self.backend, fail_silently=False)
+                self.deliver(backend, message)
+                with self.lock:
+                    self.sent += 1
+            except Exception:
+                with self.lock:
+                    self.failed += 1
+                logger.exception('Background delivery failed.')
+                # start over with a new connection for the next message
+                if backend is not None:
+                    try:
+                        backend.close()
+                    except Exception:
+                        pass
+            finally:
+                close_old_connections()
+                self.done()
+        if backend is not None:
+            backend.close()
+
+    def flush(self, timeout=None):
+        """
+        Waits until every queued message has been handled, for up to timeout
+        seconds. Returns whether they all were.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.lock:
+            while self.pending:
+                if deadline is None:
+                    self.idle.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self.idle.wait(remaining)
+        return True
+
+    def shutdown(self, timeout=None):
+        """
+        Delivers what's queued, for up to timeout seconds, then stops the
+        workers. Returns whether everything queued was handled.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        flushed = self.flush(timeout)
+        if not flushed:
+            logger.warning('Background mail queue not flushed; %d messages abandoned.' % self.pending)
+        for thread in self.threads:
+            try:
+                self.queue.put(_stop, False)
+            except queue.Full:
+                break
+        for thread in self.threads:
+            remaining = None if deadline is None else max(0, deadline - time.time())
+            thread.join(remaining)
+        return flushed
+
+    def stats(self):
+        with self.lock:
+            return {
+                'queue_depth': self.queue.qsize(),
+                'pending': self.pending,
+                'enqueued': self.enqueued,
+                'sent': self.sent,
+                'failed': self.failed,
+                'dropped': self.dropped,
+                'sent_directly': self.sent_directly,
+                'workers': len([t for t in self.threads if t.is_alive()]),
+            }
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    Returns the process's DeliveryPool, starting it from the settings if
+    needed.
+    """
+    global _pool
+    with _pool_lock:
+        # worker threads don't survive a fork
+        if _pool is None or _pool.pid != os.getpid():
+            _pool = DeliveryPool(
+                backend=getattr(settings, 'DJEMBE_BACKGROUND_BACKEND', 'djembe.backends.EncryptingSMTPBackend'),
+                workers=getattr(settings, 'DJEMBE_BACKGROUND_WORKERS', 2),
+                queue_size=getattr(settings, 'DJEMBE_BACKGROUND_QUEUE_SIZE', 1000),
+                when_full=getattr(settings, 'DJEMBE_BACKGROUND_WHEN_FULL', 'block'),
+                block_timeout=getattr(settings, 'DJEMBE_BACKGROUND_BLOCK_TIMEOUT', None),
+            )
+        return _pool
+
+
+def stats():
+    """
+    Returns the process's delivery counts and queue depth, if it has a pool.
+    """
+    pool = _pool
+    if pool is None or pool.pid != os.getpid():
+        return None
+    return pool.stats()
+
+
+def shutdown(timeout=None):
+    """
+    Flushes and stops the process's pool, if it has one. Called at exit.
+    """
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is None or pool.pid != os.getpid():
+        return True
+    if timeout is None:
+        timeout = getattr(settings, 'DJEMBE_BACKGROUND_FLUSH_TIMEOUT', 30)
+    return pool.shutdown(timeout)
+
+atexit.register(shutdown)
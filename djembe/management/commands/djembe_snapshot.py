@@ -0,0 +1,51 @@
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db import DEFAULT_DB_ALIAS
+from django.utils import timezone
+
+from djembe import snapshot
+from djembe.models import Identity
+
+
+class Command(BaseCommand):
+    help = 'Compiles all identities into a read-only snapshot file for DJEMBE_IDENTITY_SNAPSHOT.'
+
+    option_list = getattr(BaseCommand, 'option_list', ()) + (
+        make_option(
+            '--output', '-o',
+            dest='output',
+            help='Where to write the snapshot. Defaults to settings.DJEMBE_IDENTITY_SNAPSHOT.'
+        ),
+        make_option(
+            '--database',
+            dest='database',
+            default=DEFAULT_DB_ALIAS,
+            help='The database to read identities from. Defaults to the "default" database.'
+        ),
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--output', '-o',
+            dest='output',
+            help='Where to write the snapshot. Defaults to settings.DJEMBE_IDENTITY_SNAPSHOT.'
+        )
+        parser.add_argument(
+            '--database',
+            dest='database',
+            default=DEFAULT_DB_ALIAS,
+            help='The database to read identities from. Defaults to the "default" database.'
+        )
+
+    def handle(self, *args, **options):
+        path = options.get('output') or getattr(settings, 'DJEMBE_IDENTITY_SNAPSHOT', None)
+        if not path:
+            raise CommandError('Specify --output or set DJEMBE_IDENTITY_SNAPSHOT.')
+
+        identities = Identity.objects.using(options['database']).order_by('address', 'pk')
+        count = snapshot.dump(identities, path, created=timezone.now().isoformat())
+
+        self.stdout.write('Wrote %d identities to %s' % (count, path))
@@ -1,6 +1,10 @@
 import re
+import time
 
+from django.conf import settings
+from django.core import cache
 from django.db import models
+from django.db import router
 from django.utils.translation import gettext_lazy as _
 
 from M2Crypto import X509
@@ -48,3 +52,47 @@ def set_identity_address_from_certificate(sender, **kwargs):
         identity.address = str(email_address.get_data())
 
 models.signals.pre_save.connect(set_identity_address_from_certificate, sender=Identity)
+
+
+# the cache key holding when an Identity was last saved or deleted
+LAST_WRITE_KEY = 'djembe.last_identity_write'
+
+
+def get_write_cache():
+    """
+    Returns the cache that records Identity writes, named by
+    settings.DJEMBE_READ_PRIMARY_CACHE. It must be shared by every process
+    sending mail for their reads to see each other's writes.
+    """
+    alias = getattr(settings, 'DJEMBE_READ_PRIMARY_CACHE', 'default')
+    if hasattr(cache, 'caches'):
+        return cache.caches[alias]
+    return cache.get_cache(alias)
+
+
+def get_read_database():
+    """
+    Returns the database alias to read identities from when sending mail.
+
+    That's settings.DJEMBE_READ_DATABASE, unless an Identity has been written
+    within the last DJEMBE_READ_PRIMARY_AFTER_WRITE seconds, in which case
+    it's the database identities are written to, so a replica that's behind
+    can't hide a new certificate. None means Django's usual routing.
+    """
+    alias = getattr(settings, 'DJEMBE_READ_DATABASE', None)
+    if alias:
+        window = getattr(settings, 'DJEMBE_READ_PRIMARY_AFTER_WRITE', 0)
+        if window:
+            written = get_write_cache().get(LAST_WRITE_KEY)
+            if written is not None and time.time() - written < window:
+                return router.db_for_write(Identity)
+    return alias
+
+
+def record_identity_write(sender, **kwargs):
+    window = getattr(settings, 'DJEMBE_READ_PRIMARY_AFTER_WRITE', 0)
+    if window:
+        get_write_cache().set(LAST_WRITE_KEY, time.time(), window)
+
+models.signals.post_save.connect(record_identity_write, sender=Identity)
+models.signals.post_delete.connect(record_identity_write, sender=Identity)
@@ -0,0 +1,202 @@
+"""
+Opt-in profiling of EncryptingBackendMixin.send().
+
+When settings.DJEMBE_PROFILE_DIR is set, a sampled fraction of sends
+(DJEMBE_PROFILE_SAMPLE_RATE) is run under cProfile and, where available,
+tracemalloc. cProfile runs per thread, but tracemalloc traces the whole
+process, so only one send at a time has its allocations traced. If
+DJEMBE_PROFILE_THRESHOLD is set, every send is profiled, but only those taking
+at least that many seconds are kept.
+
+Each kept send leaves a .prof file for pstats and a .json file describing the
+message's shape: its size, part count, recipient counts, signer fingerprint
+and cipher, but none of its content or addresses. Only the newest
+DJEMBE_PROFILE_KEEP pairs are kept.
+"""
+import cProfile
+import itertools
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+from django.conf import settings
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+logger = logging.getLogger('djembe.profiling')
+
+# held by the one send whose allocations are being traced
+_capture_lock = threading.Lock()
+_sequence = itertools.count(1)
+
+
+class Capture(object):
+    """
+    Profiles one send. Fill in metadata while sending, then call finish().
+
+    If tracing, the caller holds _capture_lock, and finish() releases it.
+    """
+
+    def __init__(self, directory, sampled, threshold, keep, tracing=False):
+        self.directory = directory
+        self.sampled = sampled
+        self.threshold = threshold
+        self.keep = keep
+        self.tracing = tracing
+        self.metadata = {}
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        if self.tracing:
+            tracemalloc.start()
+        self.started = time.time()
+        self.profile.enable()
+
+    def finish(self, error=None, message=None):
+        """
+        Stops profiling and, if this send was sampled or slow, writes out the
+        profile, with the shape of message, the EmailMessage sent, if given.
+        Returns the path of the .prof file, or None.
+
+        It never raises, so profiling can't change the outcome of a send.
+        """
+        try:
+            try:
+                self.profile.disable()
+                elapsed = time.time() - self.started
+                slow = self.threshold is not None and elapsed >= self.threshold
+                memory = None
+                if self.tracing and (self.sampled or slow):
+                    memory = self.memory_statistics()
+            finally:
+                if self.tracing:
+                    tracemalloc.stop()
+                    _capture_lock.release()
+
+            if not (self.sampled or slow):
+                return None
+
+            # measured now, so rendering the message isn't part of the profile
+            if message is not None:
+                self.metadata.update(message_shape(message.message()))
+
+            self.metadata.update({
+                'elapsed': elapsed,
+                'error': error.__class__.__name__ if error is not None else None,
+                'memory': memory,
+                'reason': 'slow' if slow else 'sampled',
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+            })
+            return self.write()
+        except Exception as e:
+            logger.warning('Cannot write send profile to %s: %s' % (self.directory, e))
+            return None
+
+    def memory_statistics(self, limit=20):
+        current, peak = tracemalloc.get_traced_memory()
+        top = tracemalloc.take_snapshot().statistics('lineno')[:limit]
+        return {
+            'current': current,
+            'peak': peak,
+            'top': [
+                {
+                    'file': stat.traceback[0].filename,
+                    'line': stat.traceback[0].lineno,
+                    'size': stat.size,
+                    'count': stat.count,
+                }
+                for stat in top
+            ],
+        }
+
+    def write(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        name = 'send-%s-%d-%d' % (
+            time.strftime('%Y%m%d-%H%M%S', time.localtime(self.started)),
+            os.getpid(),
+            next(_sequence)
+        )
+        base = os.path.join(self.directory, name)
+
+        self.profile.dump_stats(base + '.prof')
+        with open(base + '.json', 'w') as f:
+            json.dump(self.metadata, f, indent=1, sort_keys=True)
+        logger.info('Profiled a %s send (%.3fs) to %s.prof' % (self.metadata['reason'], self.metadata['elapsed'], base))
+
+        rotate(self.directory, self.keep)
+        return base + '.prof'
+
+
+def message_shape(message):
+    """
+    Describes a message without revealing its content.
+    """
+    return {
+        'size': len(message.as_string()),
+        'parts': len([part for part in message.walk() if not part.is_multipart()]),
+    }
+
+
+def rotate(directory, keep):
+    """
+    Removes all but the newest keep profiles from directory.
+    """
+    names = sorted(
+        (os.path.getmtime(os.path.join(directory, filename)), filename[:-len('.json')])
+        for filename in os.listdir(directory)
+        if filename.startswith('send-') and filename.endswith('.json')
+    )
+    for mtime, name in names[:max(0, len(names) - keep)]:
+        for extension in ('.json', '.prof'):
+            path = os.path.join(directory, name + extension)
+            if os.path.exists(path):
+                os.unlink(path)
+
+
+def start_capture():
+    """
+    Starts profiling a send if the settings call for it, returning a Capture,
+    or None.
+    """
+    directory = getattr(settings, 'DJEMBE_PROFILE_DIR', None)
+    if not directory:
+        return None
+
+    sample_rate = getattr(settings, 'DJEMBE_PROFILE_SAMPLE_RATE', 0)
+    threshold = getattr(settings, 'DJEMBE_PROFILE_THRESHOLD', None)
+    sampled = sample_rate > 0 and random.random() < sample_rate
+    if not (sampled or threshold is not None):
+        return None
+
+    # trace allocations too, unless another send or another tool already is
+    tracing = tracemalloc is not None and _capture_lock.acquire(False)
+    if tracing and tracemalloc.is_tracing():
+        _capture_lock.release()
+        tracing = False
+
+    capture = Capture(
+        directory,
+        sampled,
+        threshold,
+        getattr(settings, 'DJEMBE_PROFILE_KEEP', 100),
+        tracing
+    )
+    try:
+        capture.start()
+    except (RuntimeError, ValueError) as e:
+        # e.g. another profiler or a coverage tool is already active
+        if capture.tracing:
+            tracemalloc.stop()
+            _capture_lock.release()
+        logger.warning('Cannot profile send: %s' % e)
+        return None
+    return capture
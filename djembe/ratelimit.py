@@ -0,0 +1,218 @@
+"""
+Token-bucket rate limits for outbound mail.
+
+Limits are configured per scope in settings.DJEMBE_RATE_LIMITS, as a rate in
+deliveries per second and a burst size::
+
+    DJEMBE_RATE_LIMITS = {
+        'relay': (10, 20),
+        'sender': (5, 5),
+        'domain': (2, 10),
+    }
+
+Every SMTP transaction takes one token from the bucket for its relay, one from
+its sender's bucket and one from the bucket of each recipient domain.
+"""
+import smtplib
+import threading
+import time
+
+from django.conf import settings
+
+
+SCOPES = ('relay', 'sender', 'domain')
+
+monotonic = getattr(time, 'monotonic', time.time)
+
+
+class RateLimitExceeded(smtplib.SMTPException):
+    """
+    Raised when a delivery would have to wait longer than
+    settings.DJEMBE_RATE_LIMIT_TIMEOUT for its turn.
+    """
+
+
+class TokenBucket(object):
+    """
+    Allows rate deliveries per second on average, in bursts of up to capacity.
+
+    Tokens are reserved rather than taken: a caller that finds the bucket
+    empty still gets a token, along with how long it must wait before using
+    it. Callers are therefore served in the order they arrived.
+    """
+
+    def __init__(self, rate, capacity=None, clock=monotonic):
+        if rate <= 0:
+            raise ValueError('Rate limits must be positive.')
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(rate, 1))
+        self.clock = clock
+        self.tokens = self.capacity
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def reserve(self, max_wait=None):
+        """
+        Reserves a token, returning the seconds to wait before using it.
+
+        If the wait would exceed max_wait, nothing is reserved and None is
+        returned.
+        """
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            wait = max(0.0, (1 - self.tokens) / self.rate)
+            if max_wait is not None and wait > max_wait:
+                return None
+            self.tokens -= 1
+            return wait
+
+    def is_full(self):
+        """
+        Whether the bucket has refilled completely, making it no different
+        from a new one.
+        """
+        with self.lock:
+            tokens = self.tokens + (self.clock() - self.updated) * self.rate
+            return tokens >= self.capacity
+
+    def refund(self):
+        """
+        Returns a reserved token that won't be used.
+        """
+        with self.lock:
+            self.tokens = min(self.capacity, self.tokens + 1)
+
+
+class RateLimiter(object):
+    """
+    Holds the token buckets for each relay, sender and recipient domain.
+
+    Buckets that have refilled are discarded every prune_interval seconds,
+    so the table only holds those used recently.
+    """
+
+    prune_interval = 60
+
+    def __init__(self, limits, timeout=None, clock=monotonic, sleep=time.sleep):
+        for scope in limits:
+            if scope not in SCOPES:
+                raise ValueError('Unknown rate limit scope %r; expected one of %s.' % (scope, ', '.join(SCOPES)))
+        self.limits = dict(limits)
+        self.timeout = timeout
+        self.clock = clock
+        self.sleep = sleep
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.pruned = clock()
+
+        self.waiting = 0
+        self.delayed = 0
+        self.rejected = 0
+        self.last_wait = 0.0
+        self.total_wait = 0.0
+
+    def get_bucket(self, scope, key):
+        with self.lock:
+            now = self.clock()
+            if now - self.pruned >= self.prune_interval:
+                self.pruned = now
+                for bucket_key, bucket in list(self.buckets.items()):
+                    if bucket.is_full():
+                        del self.buckets[bucket_key]
+
+            bucket = self.buckets.get((scope, key))
+            if bucket is None:
+                rate, capacity = self.limits[scope]
+                bucket = TokenBucket(rate, capacity, clock=self.clock)
+                self.buckets[(scope, key)] = bucket
+            return bucket
+
+    def get_buckets(self, relay, sender, recipients):
+        keys = []
+        if 'relay' in self.limits:
+            keys.append(('relay', relay))
+        if 'sender' in self.limits:
+            keys.append(('sender', sender.lower()))
+        if 'domain' in self.limits:
+            domains = set(r.rpartition('@')[2].rstrip('>').lower() for r in recipients)
+            keys.extend(('domain', domain) for domain in sorted(domains))
+        return [self.get_bucket(scope, key) for scope, key in keys]
+
+    def acquire(self, relay, sender, recipients):
+        """
+        Blocks until a delivery from sender to recipients through relay is
+        allowed, and returns how long it waited.
+
+        Raises RateLimitExceeded if that would take longer than the timeout.
+        """
+        wait = 0.0
+        reserved = []
+        for bucket in self.get_buckets(relay, sender, recipients):
+            bucket_wait = bucket.reserve(self.timeout)
+            if bucket_wait is None:
+                for reserved_bucket in reserved:
+                    reserved_bucket.refund()
+                with self.lock:
+                    self.rejected += 1
+                raise RateLimitExceeded(
+                    'Rate limit for %s would delay delivery more than %s seconds.' % (relay, self.timeout)
+                )
+            reserved.append(bucket)
+            wait = max(wait, bucket_wait)
+
+        with self.lock:
+            self.last_wait = wait
+            self.total_wait += wait
+            if wait:
+                self.delayed += 1
+                self.waiting += 1
+
+        if wait:
+            try:
+                self.sleep(wait)
+            finally:
+                with self.lock:
+                    self.waiting -= 1
+
+        return wait
+
+    def stats(self):
+        """
+        Returns the number of deliveries waiting now, and totals so far.
+        """
+        with self.lock:
+            return {
+                'queue_depth': self.waiting,
+                'delayed': self.delayed,
+                'rejected': self.rejected,
+                'last_wait': self.last_wait,
+                'total_wait': self.total_wait,
+            }
+
+
+_limiter = None
+_limiter_config = None
+_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    """
+    Returns the process-wide RateLimiter for the current settings, or None if
+    settings.DJEMBE_RATE_LIMITS is not set.
+    """
+    global _limiter, _limiter_config
+
+    limits = getattr(settings, 'DJEMBE_RATE_LIMITS', None)
+    if not limits:
+        return None
+    timeout = getattr(settings, 'DJEMBE_RATE_LIMIT_TIMEOUT', None)
+    config = (sorted(limits.items()), timeout)
+
+    with _limiter_lock:
+        if _limiter is None or _limiter_config != config:
+            _limiter = RateLimiter(limits, timeout)
+            _limiter_config = config
+        return _limiter
@@ -0,0 +1,226 @@
+"""
+Read-only snapshots of Identity records, for mail workers that should not need
+a database connection.
+
+A snapshot is a JSON document listing each identity's address, DER-encoded
+certificate and fingerprint. Private keys are not stored in the snapshot
+itself; each signing identity instead references a key file in a directory
+beside it, readable only by its owner.
+"""
+import base64
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+from M2Crypto import X509
+
+
+SNAPSHOT_FORMAT = 'djembe-identity-snapshot'
+SNAPSHOT_VERSION = 1
+
+
+class SnapshotError(Exception):
+    pass
+
+
+class SnapshotIdentity(object):
+    """
+    An identity loaded from a snapshot.
+
+    It has the attributes of djembe.models.Identity that the backends use, but
+    the certificate is parsed only once, when the snapshot is loaded.
+    """
+
+    def __init__(self, address, der, fingerprint, key=''):
+        self.address = address
+        self.fingerprint = fingerprint
+        self.key = key
+        self.x509 = X509.load_cert_der_string(der)
+        self.certificate = self.x509.as_pem()
+
+    def __repr__(self):
+        return '<SnapshotIdentity: %s %s>' % (self.address, self.fingerprint)
+
+
+class IdentitySnapshot(object):
+    """
+    An immutable set of identities, indexed by address.
+    """
+
+    def __init__(self, identities, created=None):
+        self.identities = tuple(identities)
+        self.created = created
+        self.by_address = {}
+        for identity in self.identities:
+            self.by_address.setdefault(identity.address, []).append(identity)
+
+    def __len__(self):
+        return len(self.identities)
+
+    def filter(self, addresses):
+        """
+        Returns all identities for any of the given addresses.
+        """
+        found = []
+        for address in addresses:
+            found.extend(self.by_address.get(address, []))
+        return found
+
+    def signing_identities(self, address):
+        """
+        Returns the identities for the given address that have a private key.
+        """
+        return [i for i in self.by_address.get(address, []) if i.key]
+
+
+def key_directory(path):
+    return path + '.keys'
+
+
+def _write_atomically(path, content, mode=0o644):
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.djembe-')
+    try:
+        os.fchmod(fd, mode)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temp_path, path)
+    except:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+
+
+def dump(identities, path, created=None):
+    """
+    Writes the given Identity records to a snapshot file at path.
+
+    Key files are named by their content and written first, then the snapshot
+    replaces any previous one in a single rename, so a reader sees either the
+    old snapshot or the new one. Key files referenced by neither are removed
+    afterwards; those only the old snapshot needs are left for the next run,
+    so a reader that has just opened it can still load them.
+    """
+    keys_path = key_directory(path)
+    if not os.path.isdir(keys_path):
+        os.makedirs(keys_path, 0o700)
+    previous_key_files = _referenced_key_files(path)
+
+    entries = []
+    key_files = set()
+    for identity in identities:
+        x509 = identity.x509
+        key_file = None
+        if identity.key:
+            key = str(identity.key)
+            key_file = '%s.pem' % hashlib.sha1(key).hexdigest()
+            if key_file not in key_files:
+                _write_atomically(os.path.join(keys_path, key_file), key, 0o600)
+                key_files.add(key_file)
+        entries.append({
+            'address': identity.address,
+            'certificate': base64.b64encode(x509.as_der()),
+            'fingerprint': identity.fingerprint,
+            'key': key_file,
+        })
+
+    document = {
+        'format': SNAPSHOT_FORMAT,
+        'version': SNAPSHOT_VERSION,
+        'created': created,
+        'identities': entries,
+    }
+    _write_atomically(path, json.dumps(document, indent=1, sort_keys=True))
+
+    for filename in os.listdir(keys_path):
+        if filename.endswith('.pem') and filename not in key_files | previous_key_files:
+            os.unlink(os.path.join(keys_path, filename))
+
+    return len(entries)
+
+
+def _referenced_key_files(path):
+    """
+    Returns the names of the key files the snapshot at path uses, if there is
+    a readable one.
+    """
+    try:
+        with open(path, 'rb') as f:
+            document = json.load(f)
+        return set(entry['key'] for entry in document['identities'] if entry.get('key'))
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        return set()
+
+
+def _read(path):
+    """
+    Reads the snapshot at path, returning it with the stat signature of the
+    file it was actually read from.
+    """
+    try:
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            document = json.load(f)
+    except (IOError, OSError, ValueError) as e:
+        raise SnapshotError('Cannot read identity snapshot %s: %s' % (path, e))
+
+    if document.get('format') != SNAPSHOT_FORMAT:
+        raise SnapshotError('%s is not an identity snapshot.' % path)
+    if document.get('version') != SNAPSHOT_VERSION:
+        raise SnapshotError('Unsupported identity snapshot version %s in %s.' % (document.get('version'), path))
+
+    keys_path = key_directory(path)
+    identities = []
+    for entry in document['identities']:
+        key = ''
+        if entry.get('key'):
+            try:
+                with open(os.path.join(keys_path, entry['key'])) as f:
+                    key = f.read()
+            except (IOError, OSError) as e:
+                raise SnapshotError('Cannot read key for %s: %s' % (entry['address'], e))
+        identities.append(SnapshotIdentity(
+            entry['address'],
+            base64.b64decode(entry['certificate']),
+            entry['fingerprint'],
+            key,
+        ))
+
+    signature = (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+    return signature, IdentitySnapshot(identities, document.get('created'))
+
+
+def load(path):
+    """
+    Loads the snapshot at path.
+    """
+    return _read(path)[1]
+
+
+_snapshots = {}
+_snapshots_lock = threading.Lock()
+
+
+def get_snapshot(path):
+    """
+    Returns the snapshot at path, loading it the first time it's requested and
+    again whenever the file has been replaced.
+    """
+    try:
+        st = os.stat(path)
+    except OSError as e:
+        raise SnapshotError('Cannot read identity snapshot %s: %s' % (path, e))
+    signature = (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+
+    cached = _snapshots.get(path)
+    if cached is None or cached[0] != signature:
+        with _snapshots_lock:
+            cached = _snapshots.get(path)
+            if cached is None or cached[0] != signature:
+                cached = _read(path)
+                _snapshots[path] = cached
+    return cached[1]
@@ -0,0 +1,110 @@
+"""
+Helpers for testing applications that send mail through djembe.
+
+Point EMAIL_BACKEND at djembe.backends.FakeCryptoTestBackend in your test
+settings, create identities from the bundled certificates with
+load_fixture_identities() or create_fixture_identity(), and inspect what was
+delivered with parse_envelope().
+"""
+import email
+
+from djembe import testing_data
+from djembe.backends import FakeCryptoBackendMixin
+from djembe.models import Identity
+
+
+FIXTURES = (
+    (testing_data.RECIPIENT1_CERTIFICATE, testing_data.RECIPIENT1_KEY),
+    (testing_data.RECIPIENT2_CERTIFICATE, testing_data.RECIPIENT2_KEY),
+)
+
+# (address, fixture, signing): a signing sender, a plain recipient, and an
+# alias whose mail is encrypted for both of them
+FIXTURE_IDENTITIES = (
+    ('recipient1@example.com', 0, True),
+    ('recipient2@example.com', 1, False),
+    ('list@example.com', 0, False),
+    ('list@example.com', 1, False),
+)
+
+
+def create_fixture_identity(address, signing=False, fixture=0):
+    """
+    Creates an Identity for address using one of the bundled certificates.
+
+    The address is given, so the certificate isn't parsed to find one.
+    """
+    certificate, key = FIXTURES[fixture]
+    return Identity.objects.create(
+        address=address,
+        certificate=certificate,
+        key=key if signing else ''
+    )
+
+
+def load_fixture_identities(identities=FIXTURE_IDENTITIES, using=None):
+    """
+    Creates Identity records from (address, fixture, signing) tuples in a
+    single query, and returns them.
+
+    Each bundled certificate's fingerprint is computed once per process, not
+    once per record. As with any bulk_create(), the records' primary keys may
+    not be set.
+    """
+    records = []
+    for address, fixture, signing in identities:
+        certificate, key = FIXTURES[fixture]
+        fixture_fingerprint(fixture)
+        records.append(Identity(
+            address=address,
+            certificate=certificate,
+            key=key if signing else ''
+        ))
+    return Identity.objects.using(using).bulk_create(records)
+
+
+def fixture_fingerprint(fixture=0):
+    """
+    Returns the fingerprint fake envelopes will list for a bundled
+    certificate.
+    """
+    return FakeCryptoBackendMixin().get_fingerprint(Identity(certificate=FIXTURES[fixture][0]))
+
+
+def parse_envelope(message):
+    """
+    Unwraps a message string delivered by FakeCryptoTestBackend.
+
+    Returns a dictionary saying whether it was encrypted, and for which
+    certificate fingerprints with which cipher; whether it was signed, and by
+    whom; and the content that was protected, as an email.message.Message.
+    """
+    msg = email.message_from_string(message)
+    result = {
+        'encrypted': False,
+        'recipients': [],
+        'cipher': None,
+        'signed': False,
+        'signer': None,
+        'signer_fingerprint': None,
+        'content': msg,
+    }
+
+    if msg.get_content_type() == FakeCryptoBackendMixin.encrypted_content_type:
+        msg = email.message_from_string(msg.get_payload())
+        result['encrypted'] = True
+        result['recipients'] = msg.get_all('X-Djembe-Recipient', [])
+        result['cipher'] = msg['X-Djembe-Cipher']
+        del msg['X-Djembe-Recipient']
+        del msg['X-Djembe-Cipher']
+        result['content'] = msg
+
+    if msg.get_content_type() == 'multipart/signed' and msg.get_param('protocol') == FakeCryptoBackendMixin.signature_content_type:
+        content, signature = msg.get_payload()
+        signature = email.message_from_string(signature.get_payload())
+        result['signed'] = True
+        result['signer'] = signature['Signer']
+        result['signer_fingerprint'] = signature['Fingerprint']
+        result['content'] = content
+
+    return result
@@ -0,0 +1,194 @@
+import smtplib
+import threading
+import time
+
+from django.core import mail
+from django.test import SimpleTestCase
+
+from djembe import background
+
+
+class BlockingBackend(object):
+    """
+    Holds every worker at send_messages() until released.
+    """
+    released = threading.Event()
+
+    def __init__(self, **kwargs):
+        pass
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def send_messages(self, email_messages):
+        self.released.wait()
+        return len(email_messages)
+
+
+class StandInConnection(object):
+    """
+    Answers NOOP like smtplib, until the relay closes it.
+    """
+
+    def __init__(self):
+        self.alive = True
+
+    def noop(self):
+        if not self.alive:
+            raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+        return (250, 'OK')
+
+
+class DroppingBackend(object):
+    """
+    Keeps its connection open between messages, like the SMTP backend, but
+    the relay closes it after each message.
+
+    With partial set, the relay closes it after the first of a message's two
+    deliveries instead, as if it went away between the plaintext copy and
+    the encrypted one.
+    """
+    delivered = []
+    partial = False
+
+    def __init__(self, **kwargs):
+        self.connection = None
+
+    def open(self):
+        if self.connection is None:
+            self.connection = StandInConnection()
+
+    def close(self):
+        self.connection = None
+
+    def send_messages(self, email_messages):
+        for message in email_messages:
+            if not self.connection.alive:
+                raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+            self.delivered.append(message)
+            if self.partial:
+                self.connection.alive = False
+                raise smtplib.SMTPServerDisconnected('Only partial success (messages sent before error: 1)')
+        self.connection.alive = False
+        return len(email_messages)
+
+
+class FailingBackend(object):
+    """
+    Fails to send anything, raising unless told to fail silently.
+    """
+
+    def __init__(self, fail_silently=False, **kwargs):
+        self.fail_silently = fail_silently
+
+    def send_messages(self, email_messages):
+        if not self.fail_silently:
+            raise smtplib.SMTPConnectError(421, 'Try again later')
+        return 0
+
+
+class BackgroundTest(SimpleTestCase):
+
+    def setUp(self):
+        mail.outbox = []
+        BlockingBackend.released.clear()
+
+    def tearDown(self):
+        BlockingBackend.released.set()
+        background.shutdown(5)
+
+    def message(self, subject='Background'):
+        return mail.EmailMessage(subject, 'Body', 'sender@example.com', ['recipient@example.com'])
+
+    def testDelivery(self):
+        with self.settings(DJEMBE_BACKGROUND_BACKEND='django.core.mail.backends.locmem.EmailBackend'):
+            backend = mail.get_connection('djembe.backends.BackgroundEncryptingBackend')
+            self.assertEqual(backend.send_messages([self.message(), self.message()]), 2)
+            self.assertTrue(background.shutdown(5))
+
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(background.stats(), None)
+
+    def testWhenFull(self):
+        pool = background.DeliveryPool(
+            backend='djembe.tests.test_background.BlockingBackend',
+            workers=1,
+            queue_size=1,
+            when_full='drop'
+        )
+        # one message for the worker to hold, one waiting in the queue
+        self.assertTrue(pool.put(self.message()))
+        while pool.queue.qsize():
+            time.sleep(0.01)
+        self.assertTrue(pool.put(self.message()))
+        self.assertFalse(pool.put(self.message()))
+
+        pool.when_full = 'raise'
+        self.assertRaises(background.QueueFull, pool.put, self.message())
+
+        stats = pool.stats()
+        self.assertEqual(stats['queue_depth'], 1)
+        self.assertEqual(stats['pending'], 2)
+        self.assertEqual(stats['dropped'], 1)
+
+        self.assertFalse(pool.flush(0.05))
+        BlockingBackend.released.set()
+        self.assertTrue(pool.shutdown(5))
+        self.assertEqual(pool.stats()['sent'], 2)
+        self.assertEqual(pool.stats()['workers'], 0)
+
+    def testReconnect(self):
+        del DroppingBackend.delivered[:]
+        DroppingBackend.partial = False
+        pool = background.DeliveryPool(backend='djembe.tests.test_background.DroppingBackend', workers=1)
+        pool.put(self.message('First'))
+        pool.put(self.message('Second'))
+        self.assertTrue(pool.shutdown(5))
+
+        self.assertEqual([m.subject for m in DroppingBackend.delivered], ['First', 'Second'])
+        self.assertEqual(pool.stats()['sent'], 2)
+        self.assertEqual(pool.stats()['failed'], 0)
+
+    def testPartialDelivery(self):
+        # a message that was partly delivered isn't sent again
+        del DroppingBackend.delivered[:]
+        DroppingBackend.partial = True
+        try:
+            pool = background.DeliveryPool(backend='djembe.tests.test_background.DroppingBackend', workers=1)
+            pool.put(self.message('First'))
+            self.assertTrue(pool.flush(5))
+            DroppingBackend.partial = False
+            pool.put(self.message('Second'))
+            self.assertTrue(pool.shutdown(5))
+        finally:
+            DroppingBackend.partial = False
+
+        self.assertEqual([m.subject for m in DroppingBackend.delivered], ['First', 'Second'])
+        self.assertEqual(pool.stats()['sent'], 1)
+        self.assertEqual(pool.stats()['failed'], 1)
+
+    def testSendFailSilently(self):
+        # no workers, so the queue stays full
+        pool = background.DeliveryPool(
+            backend='djembe.tests.test_background.FailingBackend',
+            workers=0,
+            queue_size=1,
+            when_full='send'
+        )
+        self.assertTrue(pool.put(self.message()))
+        self.assertFalse(pool.put(self.message(), fail_silently=True))
+        self.assertRaises(smtplib.SMTPConnectError, pool.put, self.message())
+
+    def testBadBackend(self):
+        pool = background.DeliveryPool(backend='djembe.tests.test_background.MissingBackend', workers=1)
+        pool.put(self.message())
+        pool.put(self.message())
+        self.assertTrue(pool.flush(5))
+        self.assertEqual(pool.stats()['failed'], 2)
+        self.assertTrue(pool.shutdown(5))
+
+    def testBadSetting(self):
+        self.assertRaises(ValueError, background.DeliveryPool, workers=0, when_full='wait')
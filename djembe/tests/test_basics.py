@@ -1,8 +1,10 @@
+import copy
+
 from django.core import mail
 from django.test import TestCase
 
+from djembe import testing_data as data
 from djembe.models import Identity
-from djembe.tests import data
 
 from M2Crypto import BIO
 from M2Crypto import SMIME
@@ -114,6 +116,43 @@ class EncryptionTest(TestCase):
         # verify that the plaintext also got through
         msg = BIO.MemoryBuffer(backend.messages[1]['message'])
 
+    def decrypt(self, message, certificate, key):
+        s = SMIME.SMIME()
+        s.load_key_bio(BIO.MemoryBuffer(key), BIO.MemoryBuffer(certificate))
+        p7, msg_data = SMIME.smime_load_pkcs7_bio(BIO.MemoryBuffer(message))
+        return s.decrypt(p7)
+
+    def testEnvelopeLimit(self):
+        """
+        Each envelope is encrypted only for its own recipients' certificates.
+        """
+        backend = mail.get_connection()
+        del backend.messages[:]
+
+        with self.settings(DJEMBE_MAX_RECIPIENTS_PER_ENVELOPE=1):
+            mail.send_mail(
+                'Envelopes',
+                'One for each of you.',
+                'sender@example.com',
+                ['recipient2@example.com', 'list@example.com'],
+            )
+
+        self.assertEqual(len(backend.messages), 2)
+        envelopes = dict((tuple(m['recipients']), m['message']) for m in backend.messages)
+
+        # the list's envelope carries both certificates
+        message = envelopes[('list@example.com',)]
+        self.assertTrue('One for each of you.' in self.decrypt(message, data.RECIPIENT1_CERTIFICATE, data.RECIPIENT1_KEY))
+        self.assertTrue('One for each of you.' in self.decrypt(message, data.RECIPIENT2_CERTIFICATE, data.RECIPIENT2_KEY))
+
+        # recipient2's only carries its own
+        message = envelopes[('recipient2@example.com',)]
+        self.assertTrue('One for each of you.' in self.decrypt(message, data.RECIPIENT2_CERTIFICATE, data.RECIPIENT2_KEY))
+        self.assertRaises(
+            SMIME.PKCS7_Error,
+            self.decrypt, message, data.RECIPIENT1_CERTIFICATE, data.RECIPIENT1_KEY
+        )
+
     def testEncryptedDeliveryProblem(self):
         subject = 'No! Not the radio!'
         body = "10-4 good buddy!"
@@ -178,6 +217,27 @@ class EncryptionTest(TestCase):
         except ValueError:
             pass
 
+    def testUniqueCertificates(self):
+        backend = mail.get_connection()
+        identities = list(Identity.objects.order_by('pk'))
+        self.assertEqual(len(identities), 4)
+        self.assertEqual(
+            backend.unique_certificates(identities),
+            [self.recipient1, self.recipient2]
+        )
+        self.assertEqual(backend.unique_certificates([]), [])
+
+    def testUniqueCertificatesSize(self):
+        # the list's certificates are also on file for the other two addresses
+        backend = mail.get_connection()
+        identities = list(Identity.objects.order_by('pk'))
+        message = mail.EmailMessage('Size', 'Smaller', 'sender@example.com', ['list@example.com']).message()
+
+        deduplicated = backend.encrypt('sender@example.com', identities, copy.deepcopy(message)).as_string()
+        backend.unique_certificates = list
+        duplicated = backend.encrypt('sender@example.com', identities, message).as_string()
+        self.assertTrue(len(deduplicated) < len(duplicated))
+
     def testSenderIdentity(self):
         backend = mail.get_connection()
 
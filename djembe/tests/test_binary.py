@@ -0,0 +1,209 @@
+import base64
+import email
+import SocketServer
+import threading
+
+from django.core import mail
+from django.test import TestCase
+
+from djembe import testing
+from djembe import testing_data as data
+from djembe.backends import EncryptingSMTPBackend
+
+from M2Crypto import BIO
+from M2Crypto import SMIME
+from M2Crypto import SSL
+
+
+class RelayHandler(SocketServer.StreamRequestHandler):
+    """
+    Speaks just enough SMTP to accept mail with DATA or BDAT, optionally
+    over TLS.
+    """
+    tls = None
+
+    def reply(self, *lines):
+        for line in lines[:-1]:
+            self.wfile.write('250-%s\r\n' % line)
+        self.wfile.write('%s\r\n' % lines[-1])
+
+    def handle(self):
+        relay = self.server
+        transaction = None
+        if relay.implicit_tls:
+            self.start_tls()
+        self.reply('220 relay.example.com ESMTP')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            words = line.rstrip('\r\n').split(' ')
+            verb = words[0].upper()
+            relay.commands.append(' '.join([verb] + words[1:]))
+
+            if verb == 'EHLO':
+                extensions = relay.extensions[:]
+                if relay.tls_context is not None and self.tls is None:
+                    extensions.append('STARTTLS')
+                self.reply('relay.example.com', *(extensions + ['250 HELP']))
+            elif verb == 'STARTTLS' and relay.tls_context is not None and self.tls is None:
+                self.reply('220 Ready to start TLS')
+                self.start_tls()
+                transaction = None
+            elif verb in ('HELO', 'NOOP', 'RSET'):
+                transaction = None
+                self.reply('250 OK')
+            elif verb == 'MAIL':
+                transaction = {'recipients': [], 'data': ''}
+                self.reply('250 OK')
+            elif verb == 'RCPT':
+                address = words[1].split(':', 1)[1].strip('<>')
+                if address.startswith('unknown'):
+                    self.reply('550 No such user')
+                else:
+                    transaction['recipients'].append(address)
+                    self.reply('250 OK')
+            elif verb == 'BDAT':
+                transaction['data'] += self.rfile.read(int(words[1]))
+                if words[-1].upper() == 'LAST':
+                    relay.messages.append(transaction)
+                    transaction = None
+                self.reply('250 OK')
+            elif verb == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                lines = []
+                for line in iter(self.rfile.readline, ''):
+                    if line == '.\r\n':
+                        break
+                    lines.append(line[1:] if line.startswith('.') else line)
+                transaction['data'] = ''.join(lines)
+                relay.messages.append(transaction)
+                transaction = None
+                self.reply('250 OK')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                break
+            else:
+                self.reply('502 Command not implemented')
+
+    def finish(self):
+        SocketServer.StreamRequestHandler.finish(self)
+        if self.tls is not None:
+            self.tls.close(freeBio=True)
+
+    def start_tls(self):
+        self.tls = SSL.Connection(self.server.tls_context, sock=self.request)
+        self.tls.setup_ssl()
+        self.tls.set_accept_state()
+        self.tls.accept_ssl()
+        self.rfile = self.tls.makefile('rb')
+        self.wfile = self.tls.makefile('wb', 0)
+
+
+class Relay(SocketServer.ThreadingTCPServer):
+    """
+    A local SMTP relay advertising the given extensions, which records the
+    commands and messages it receives.
+
+    Given an M2Crypto SSL context, it offers STARTTLS, or with implicit_tls,
+    speaks TLS from the start like an SMTPS relay.
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, extensions, tls_context=None, implicit_tls=False):
+        SocketServer.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), RelayHandler)
+        self.extensions = extensions
+        self.tls_context = tls_context
+        self.implicit_tls = implicit_tls
+        self.commands = []
+        self.messages = []
+        self.port = self.server_address[1]
+        self.thread = threading.Thread(target=self.serve_forever, args=(0.05,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+
+
+class BinaryTransferTest(TestCase):
+
+    def setUp(self):
+        testing.load_fixture_identities()
+        testing.create_fixture_identity('unknown@example.com', fixture=1)
+        self.relay = None
+
+    def tearDown(self):
+        if self.relay is not None:
+            self.relay.stop()
+
+    def send(self, extensions, recipients=['recipient2@example.com']):
+        self.relay = Relay(extensions)
+        backend = EncryptingSMTPBackend(host='127.0.0.1', port=self.relay.port)
+        backend.bdat_chunk_size = 400
+        message = mail.EmailMessage(
+            'Binary',
+            'Delivered in binary chunks.',
+            'recipient1@example.com',
+            recipients
+        )
+        return backend.send_messages([message])
+
+    def decrypt(self, message, certificate, key):
+        s = SMIME.SMIME()
+        s.load_key_bio(BIO.MemoryBuffer(key), BIO.MemoryBuffer(certificate))
+        p7, msg_data = SMIME.smime_load_pkcs7_bio(BIO.MemoryBuffer(message))
+        return s.decrypt(p7)
+
+    def testBinary(self):
+        with self.settings(DJEMBE_BINARY_TRANSFER=True):
+            sent = self.send(
+                ['CHUNKING', 'BINARYMIME'],
+                ['recipient2@example.com', 'unknown@example.com']
+            )
+        self.assertEqual(sent, 1)
+        self.assertEqual(len(self.relay.messages), 1)
+        delivered = self.relay.messages[0]
+        # the refused recipient doesn't stop delivery to the other
+        self.assertEqual(delivered['recipients'], ['recipient2@example.com'])
+
+        mail_commands = [c for c in self.relay.commands if c.startswith('MAIL ')]
+        self.assertEqual(mail_commands, ['MAIL FROM:<recipient1@example.com> BODY=BINARYMIME'])
+        bdat_commands = [c for c in self.relay.commands if c.startswith('BDAT ')]
+        self.assertTrue(len(bdat_commands) > 1)
+        self.assertEqual(bdat_commands[:-1], ['BDAT 400'] * (len(bdat_commands) - 1))
+        self.assertEqual(bdat_commands[-1], 'BDAT %d LAST' % (len(delivered['data']) - 400 * (len(bdat_commands) - 1)))
+        self.assertFalse([c for c in self.relay.commands if c == 'DATA'])
+
+        headers, body = delivered['data'].split('\r\n\r\n', 1)
+        headers = headers.split('\r\n')
+        self.assertTrue('Content-Transfer-Encoding: binary' in headers)
+        self.assertTrue('Subject: Binary' in headers)
+
+        # the body is the DER the text message would have carried in base64
+        text = '\n'.join(
+            [h for h in headers if not h.startswith('Content-Transfer-Encoding:')]
+            + ['Content-Transfer-Encoding: base64', '', base64.encodestring(body)]
+        )
+        content = self.decrypt(text, data.RECIPIENT2_CERTIFICATE, data.RECIPIENT2_KEY)
+        self.assertTrue('Delivered in binary chunks.' in content)
+
+    def testFallback(self):
+        # without BINARYMIME the relay gets the usual base64 text
+        with self.settings(DJEMBE_BINARY_TRANSFER=True):
+            self.assertEqual(self.send(['CHUNKING']), 1)
+        self.assertFalse([c for c in self.relay.commands if c.startswith('BDAT ')])
+        self.assertTrue('DATA' in self.relay.commands)
+
+        message = self.relay.messages[0]['data']
+        self.assertEqual(email.message_from_string(message)['Content-Transfer-Encoding'], 'base64')
+        content = self.decrypt(message, data.RECIPIENT2_CERTIFICATE, data.RECIPIENT2_KEY)
+        self.assertTrue('Delivered in binary chunks.' in content)
+
+    def testDisabled(self):
+        self.assertEqual(self.send(['CHUNKING', 'BINARYMIME']), 1)
+        self.assertFalse([c for c in self.relay.commands if c.startswith('BDAT ')])
+        self.assertEqual(len(self.relay.messages), 1)
@@ -0,0 +1,63 @@
+import time
+
+from django.core import mail
+from django.test import TestCase
+
+from djembe import models
+from djembe import testing_data as data
+from djembe.models import Identity
+
+
+class ReadDatabaseTest(TestCase):
+
+    def setUp(self):
+        models.get_write_cache().delete(models.LAST_WRITE_KEY)
+
+    def testDefault(self):
+        self.assertEqual(models.get_read_database(), None)
+
+    def testReplica(self):
+        with self.settings(DJEMBE_READ_DATABASE='replica'):
+            self.assertEqual(models.get_read_database(), 'replica')
+
+            # without a window, writes don't matter
+            Identity.objects.create(
+                certificate=data.RECIPIENT1_CERTIFICATE,
+                address='recipient1@example.com'
+            )
+            self.assertEqual(models.get_read_database(), 'replica')
+
+    def testPrimaryAfterWrite(self):
+        with self.settings(DJEMBE_READ_DATABASE='replica', DJEMBE_READ_PRIMARY_AFTER_WRITE=30):
+            self.assertEqual(models.get_read_database(), 'replica')
+
+            identity = Identity.objects.create(
+                certificate=data.RECIPIENT1_CERTIFICATE,
+                address='recipient1@example.com'
+            )
+            self.assertEqual(models.get_read_database(), 'default')
+
+            models.get_write_cache().set(models.LAST_WRITE_KEY, time.time() - 31)
+            self.assertEqual(models.get_read_database(), 'replica')
+
+            identity.delete()
+            self.assertEqual(models.get_read_database(), 'default')
+
+    def testOtherProcessWrite(self):
+        # another process's write is seen through the shared cache
+        with self.settings(DJEMBE_READ_DATABASE='replica', DJEMBE_READ_PRIMARY_AFTER_WRITE=30):
+            models.get_write_cache().set(models.LAST_WRITE_KEY, time.time())
+            self.assertEqual(models.get_read_database(), 'default')
+
+    def testBackendQueries(self):
+        backend = mail.get_connection('djembe.backends.FakeCryptoTestBackend')
+        with self.settings(DJEMBE_READ_DATABASE='replica', DJEMBE_READ_PRIMARY_AFTER_WRITE=30):
+            self.assertEqual(backend.get_encrypting_identities(['recipient1@example.com']).db, 'replica')
+            self.assertEqual(backend.get_signing_identities('recipient1@example.com').db, 'replica')
+
+            Identity.objects.create(
+                certificate=data.RECIPIENT1_CERTIFICATE,
+                address='recipient1@example.com'
+            )
+            self.assertEqual(backend.get_encrypting_identities(['recipient1@example.com']).db, 'default')
+            self.assertEqual(backend.get_signing_identities('recipient1@example.com').db, 'default')
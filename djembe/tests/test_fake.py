@@ -0,0 +1,124 @@
+import email
+
+from django.core import mail
+from django.test import TestCase
+
+from djembe import testing
+from djembe import testing_data as data
+from djembe.backends import FakeCryptoTestBackend
+
+
+class FakeCryptoTest(TestCase):
+
+    def setUp(self):
+        del FakeCryptoTestBackend.messages[:]
+        self.backend = mail.get_connection('djembe.backends.FakeCryptoTestBackend')
+
+        testing.create_fixture_identity('sender@example.com', signing=True)
+        testing.create_fixture_identity('list@example.com', fixture=0)
+        testing.create_fixture_identity('list@example.com', fixture=1)
+
+    def testRouting(self):
+        message = mail.EmailMultiAlternatives(
+            'Routing',
+            'Text body',
+            'sender@example.com',
+            ['list@example.com', 'plain@example.com']
+        )
+        message.attach_alternative('<p>HTML body</p>', 'text/html')
+        self.assertEqual(self.backend.send_messages([message]), 2)
+
+        plaintext, encrypted = FakeCryptoTestBackend.messages
+        self.assertEqual(plaintext['recipients'], set(['plain@example.com']))
+        self.assertEqual(encrypted['recipients'], set(['list@example.com']))
+
+        envelope = testing.parse_envelope(plaintext['message'])
+        self.assertFalse(envelope['encrypted'])
+        self.assertTrue(envelope['signed'])
+        self.assertEqual(envelope['signer'], 'sender@example.com')
+
+        envelope = testing.parse_envelope(encrypted['message'])
+        self.assertTrue(envelope['encrypted'])
+        self.assertEqual(envelope['cipher'], 'aes_256_cbc')
+        self.assertEqual(sorted(envelope['recipients']), sorted([
+            testing.fixture_fingerprint(0),
+            testing.fixture_fingerprint(1),
+        ]))
+        self.assertTrue(envelope['signed'])
+        self.assertEqual(envelope['signer_fingerprint'], testing.fixture_fingerprint(0))
+        self.assertEqual(envelope['content'].get_content_type(), 'multipart/alternative')
+        self.assertTrue('<p>HTML body</p>' in envelope['content'].as_string())
+
+        # the outer headers are those of a real S/MIME message
+        outer = email.message_from_string(encrypted['message'])
+        self.assertEqual(outer['Subject'], 'Routing')
+        self.assertEqual(outer.get_param('smime-type'), 'enveloped-data')
+
+    def testDeterministic(self):
+        for i in range(2):
+            mail.EmailMessage(
+                'Same',
+                'Same body',
+                'unsigned@example.com',
+                ['list@example.com'],
+                connection=self.backend
+            ).send()
+        first, second = [
+            testing.parse_envelope(m['message'])['content'].as_string()
+            for m in FakeCryptoTestBackend.messages
+        ]
+        self.assertEqual(first, second)
+
+    def testDuplicateCertificates(self):
+        mail.EmailMessage(
+            'Duplicates',
+            'Body',
+            'unsigned@example.com',
+            ['sender@example.com', 'list@example.com'],
+            connection=self.backend
+        ).send()
+        self.assertEqual(len(FakeCryptoTestBackend.messages), 1)
+        envelope = testing.parse_envelope(FakeCryptoTestBackend.messages[0]['message'])
+        self.assertEqual(len(envelope['recipients']), 2)
+
+    def testEnvelopeLimit(self):
+        message = mail.EmailMessage(
+            'Limited',
+            'Body',
+            'sender@example.com',
+            ['sender@example.com', 'list@example.com', 'plain@example.com'],
+        )
+        with self.settings(DJEMBE_MAX_RECIPIENTS_PER_ENVELOPE=1):
+            self.assertEqual(self.backend.send_messages([message]), 3)
+
+        plaintext, list_envelope, sender_envelope = FakeCryptoTestBackend.messages
+        self.assertEqual(list_envelope['recipients'], set(['list@example.com']))
+        self.assertEqual(sender_envelope['recipients'], set(['sender@example.com']))
+
+        envelope = testing.parse_envelope(list_envelope['message'])
+        self.assertEqual(len(envelope['recipients']), 2)
+        self.assertTrue(envelope['signed'])
+        envelope = testing.parse_envelope(sender_envelope['message'])
+        self.assertEqual(envelope['recipients'], [testing.fixture_fingerprint(0)])
+        self.assertTrue(envelope['signed'])
+
+    def testBulkFixtures(self):
+        testing.load_fixture_identities()
+        message = mail.EmailMessage(
+            'Bulk',
+            'Body',
+            'recipient1@example.com',
+            ['recipient2@example.com'],
+        )
+        self.assertEqual(self.backend.send_messages([message]), 1)
+
+        envelope = testing.parse_envelope(FakeCryptoTestBackend.messages[0]['message'])
+        self.assertEqual(envelope['recipients'], [testing.fixture_fingerprint(1)])
+        self.assertEqual(envelope['signer'], 'recipient1@example.com')
+
+    def testFixtureFingerprint(self):
+        self.assertEqual(
+            testing.fixture_fingerprint(0),
+            'C6:AF:98:41:75:D4:10:E9:BE:0A:5C:D8:7F:0E:6F:BB:A7:E1:B0:0E'
+        )
+        self.assertEqual(testing.FIXTURES[1][0], data.RECIPIENT2_CERTIFICATE)
@@ -0,0 +1,125 @@
+import json
+import os
+import shutil
+import tempfile
+
+from django.core import mail
+from django.test import TestCase
+
+from djembe import profiling
+from djembe import testing
+
+
+class ProfilingTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.backend = mail.get_connection('djembe.backends.FakeCryptoTestBackend')
+        testing.create_fixture_identity('sender@example.com', signing=True)
+        testing.create_fixture_identity('list@example.com')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def send(self, count=1):
+        for i in range(count):
+            message = mail.EmailMessage(
+                'Secret subject',
+                'Secret body',
+                'sender@example.com',
+                ['list@example.com', 'plain@example.com'],
+                connection=self.backend
+            )
+            message.attach('secret.txt', 'Secret attachment', 'text/plain')
+            message.send()
+
+    def profiles(self):
+        return sorted(f for f in os.listdir(self.directory) if f.endswith('.json'))
+
+    def testDisabled(self):
+        with self.settings(DJEMBE_PROFILE_DIR=self.directory):
+            self.send()
+        self.assertEqual(self.profiles(), [])
+
+    def testSampled(self):
+        with self.settings(DJEMBE_PROFILE_DIR=self.directory, DJEMBE_PROFILE_SAMPLE_RATE=1):
+            self.send()
+
+        profiles = self.profiles()
+        self.assertEqual(len(profiles), 1)
+        self.assertTrue(os.path.exists(os.path.join(self.directory, profiles[0][:-5] + '.prof')))
+
+        with open(os.path.join(self.directory, profiles[0])) as f:
+            content = f.read()
+        for secret in ('Secret', 'example.com'):
+            self.assertFalse(secret in content)
+
+        metadata = json.loads(content)
+        self.assertEqual(metadata['reason'], 'sampled')
+        self.assertEqual(metadata['parts'], 2)
+        self.assertEqual(metadata['encrypting_recipients'], 1)
+        self.assertEqual(metadata['plaintext_recipients'], 1)
+        self.assertEqual(metadata['signer'], testing.fixture_fingerprint(0))
+        self.assertEqual(metadata['cipher'], 'aes_256_cbc')
+
+    def testThreshold(self):
+        with self.settings(DJEMBE_PROFILE_DIR=self.directory, DJEMBE_PROFILE_THRESHOLD=60):
+            self.send()
+        self.assertEqual(self.profiles(), [])
+
+        with self.settings(DJEMBE_PROFILE_DIR=self.directory, DJEMBE_PROFILE_THRESHOLD=0):
+            self.send()
+        with open(os.path.join(self.directory, self.profiles()[0])) as f:
+            self.assertEqual(json.load(f)['reason'], 'slow')
+
+    def testRotation(self):
+        with self.settings(DJEMBE_PROFILE_DIR=self.directory, DJEMBE_PROFILE_THRESHOLD=0, DJEMBE_PROFILE_KEEP=2):
+            self.send(3)
+        self.assertEqual(len(self.profiles()), 2)
+        self.assertEqual(len(os.listdir(self.directory)), 4)
+
+    def testInterrupted(self):
+        def interrupt(email_message, shape=None):
+            raise KeyboardInterrupt
+        self.backend._send = interrupt
+
+        with self.settings(DJEMBE_PROFILE_DIR=self.directory, DJEMBE_PROFILE_SAMPLE_RATE=1):
+            self.assertRaises(KeyboardInterrupt, self.send)
+
+        with open(os.path.join(self.directory, self.profiles()[0])) as f:
+            self.assertEqual(json.load(f)['error'], 'KeyboardInterrupt')
+        self.assertTrue(profiling._capture_lock.acquire(False))
+        profiling._capture_lock.release()
+
+    def testConcurrent(self):
+        # a send tracing allocations elsewhere doesn't stop this one being profiled
+        profiling._capture_lock.acquire()
+        try:
+            with self.settings(DJEMBE_PROFILE_DIR=self.directory, DJEMBE_PROFILE_SAMPLE_RATE=1):
+                self.send()
+        finally:
+            profiling._capture_lock.release()
+
+        with open(os.path.join(self.directory, self.profiles()[0])) as f:
+            metadata = json.load(f)
+        self.assertEqual(metadata['memory'], None)
+        self.assertEqual(metadata['parts'], 2)
+
+    def testBrokenProfile(self):
+        # profiling failures neither fail a delivered send nor hide a real error
+        def broken(message):
+            raise RuntimeError('Cannot describe the message')
+        message_shape, profiling.message_shape = profiling.message_shape, broken
+        try:
+            with self.settings(DJEMBE_PROFILE_DIR=self.directory, DJEMBE_PROFILE_SAMPLE_RATE=1):
+                del self.backend.messages[:]
+                self.send()
+                self.assertEqual(len(self.backend.messages), 2)
+
+                def fail(email_message, shape=None):
+                    raise ValueError('Delivery failed')
+                self.backend._send = fail
+                self.assertRaises(ValueError, self.send)
+        finally:
+            profiling.message_shape = message_shape
+        self.assertEqual(self.profiles(), [])
@@ -0,0 +1,110 @@
+from django.test import SimpleTestCase
+
+from djembe.ratelimit import RateLimiter
+from djembe.ratelimit import RateLimitExceeded
+from djembe.ratelimit import TokenBucket
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+class RateLimitTest(SimpleTestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def testBucketBurstThenRate(self):
+        bucket = TokenBucket(2, 3, clock=self.clock)
+        self.assertEqual([bucket.reserve() for i in range(3)], [0.0, 0.0, 0.0])
+        self.assertEqual(bucket.reserve(), 0.5)
+        self.assertEqual(bucket.reserve(), 1.0)
+
+        # refilling never exceeds the burst size
+        self.clock.now += 60
+        self.assertEqual([bucket.reserve() for i in range(3)], [0.0, 0.0, 0.0])
+        self.assertEqual(bucket.reserve(), 0.5)
+
+    def testBucketMaxWait(self):
+        bucket = TokenBucket(1, 1, clock=self.clock)
+        self.assertEqual(bucket.reserve(0), 0.0)
+        self.assertEqual(bucket.reserve(0.5), None)
+        # a refused reservation takes nothing
+        self.assertEqual(bucket.reserve(), 1.0)
+
+    def testBlocking(self):
+        limiter = RateLimiter(
+            {'relay': (1, 1)},
+            clock=self.clock,
+            sleep=self.clock.sleep
+        )
+        limiter.acquire('relay:25', 'a@example.com', ['b@example.com'])
+        limiter.acquire('relay:25', 'a@example.com', ['b@example.com'])
+        self.assertEqual(self.clock.slept, [1.0])
+
+        stats = limiter.stats()
+        self.assertEqual(stats['queue_depth'], 0)
+        self.assertEqual(stats['delayed'], 1)
+        self.assertEqual(stats['last_wait'], 1.0)
+
+        # other relays have their own buckets
+        self.assertEqual(limiter.acquire('other:25', 'a@example.com', ['b@example.com']), 0.0)
+
+    def testDomains(self):
+        limiter = RateLimiter(
+            {'domain': (1, 1)},
+            clock=self.clock,
+            sleep=self.clock.sleep
+        )
+        limiter.acquire('relay:25', 'a@example.com', ['b@example.com', 'c@example.org'])
+        self.assertEqual(limiter.acquire('relay:25', 'a@example.com', ['d@example.net']), 0.0)
+        self.assertEqual(limiter.acquire('relay:25', 'a@example.com', ['d@EXAMPLE.org']), 1.0)
+
+    def testBoundedWait(self):
+        limiter = RateLimiter(
+            {'relay': (10, 10), 'sender': (1, 1)},
+            timeout=0.5,
+            clock=self.clock,
+            sleep=self.clock.sleep
+        )
+        limiter.acquire('relay:25', 'a@example.com', ['b@example.com'])
+        self.assertRaises(
+            RateLimitExceeded,
+            limiter.acquire, 'relay:25', 'a@example.com', ['b@example.com']
+        )
+        self.assertEqual(limiter.stats()['rejected'], 1)
+        self.assertEqual(self.clock.slept, [])
+
+        # the relay token reserved before the sender refused was given back
+        self.assertEqual(limiter.buckets[('relay', 'relay:25')].tokens, 9.0)
+
+    def testPruning(self):
+        # waits don't pass any time here, so the busy bucket stays drained
+        limiter = RateLimiter(
+            {'domain': (1, 2)},
+            clock=self.clock,
+            sleep=lambda seconds: None
+        )
+        for i in range(100):
+            limiter.acquire('relay:25', 'a@example.com', ['b@example%d.com' % i])
+        for i in range(100):
+            limiter.acquire('relay:25', 'a@example.com', ['b@busy.com'])
+        self.assertEqual(len(limiter.buckets), 101)
+
+        # a minute on, only the buckets that haven't refilled are kept
+        self.clock.now += limiter.prune_interval
+        limiter.acquire('relay:25', 'a@example.com', ['b@example.com'])
+        self.assertEqual(sorted(key for scope, key in limiter.buckets), ['busy.com', 'example.com'])
+
+    def testUnknownScope(self):
+        self.assertRaises(ValueError, RateLimiter, {'recipient': (1, 1)})
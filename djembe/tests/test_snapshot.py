@@ -0,0 +1,86 @@
+import os
+import shutil
+import tempfile
+
+from StringIO import StringIO
+
+from django.core import mail
+from django.core.management import call_command
+from django.test import TestCase
+
+from djembe import snapshot
+from djembe import testing_data as data
+from djembe.models import Identity
+
+
+class SnapshotTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'identities.json')
+
+        self.recipient1 = Identity.objects.create(
+            certificate=data.RECIPIENT1_CERTIFICATE,
+            key=data.RECIPIENT1_KEY
+        )
+        self.recipient2 = Identity.objects.create(
+            certificate=data.RECIPIENT2_CERTIFICATE
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testRoundTrip(self):
+        call_command('djembe_snapshot', output=self.path, stdout=StringIO())
+
+        loaded = snapshot.load(self.path)
+        self.assertEqual(len(loaded), 2)
+
+        signers = loaded.signing_identities('recipient1@example.com')
+        self.assertEqual(len(signers), 1)
+        self.assertEqual(signers[0].fingerprint, self.recipient1.fingerprint)
+        self.assertEqual(signers[0].key, data.RECIPIENT1_KEY)
+        self.assertEqual(loaded.signing_identities('recipient2@example.com'), [])
+
+        # the key lives beside the snapshot, not in it
+        with open(self.path) as f:
+            self.assertFalse('PRIVATE KEY' in f.read())
+
+    def testLookupsWithoutDatabase(self):
+        call_command('djembe_snapshot', output=self.path, stdout=StringIO())
+        Identity.objects.all().delete()
+
+        with self.settings(DJEMBE_IDENTITY_SNAPSHOT=self.path):
+            backend = mail.get_connection('djembe.backends.EncryptingTestBackend')
+            sender = backend.get_sender_identity('recipient1@example.com')
+            self.assertEqual(sender.fingerprint, self.recipient1.fingerprint)
+
+            identities, encrypting, plaintext = backend.analyze_recipients(
+                mail.EmailMessage(
+                    'Subject',
+                    'Body',
+                    'recipient1@example.com',
+                    ['recipient2@example.com', 'recipient3@example.com']
+                )
+            )
+            self.assertEqual(encrypting, set(['recipient2@example.com']))
+            self.assertEqual(plaintext, set(['recipient3@example.com']))
+
+    def testReload(self):
+        call_command('djembe_snapshot', output=self.path, stdout=StringIO())
+        first = snapshot.get_snapshot(self.path)
+        self.assertTrue(snapshot.get_snapshot(self.path) is first)
+
+        self.recipient1.delete()
+        call_command('djembe_snapshot', output=self.path, stdout=StringIO())
+        second = snapshot.get_snapshot(self.path)
+        self.assertFalse(second is first)
+        self.assertEqual(len(second), 1)
+
+        # a reader that opened the first snapshot can still load its key...
+        keys_path = snapshot.key_directory(self.path)
+        self.assertEqual(len(os.listdir(keys_path)), 1)
+
+        # ...until the snapshot after next
+        call_command('djembe_snapshot', output=self.path, stdout=StringIO())
+        self.assertEqual(os.listdir(keys_path), [])
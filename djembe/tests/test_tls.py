@@ -0,0 +1,91 @@
+import os
+import shutil
+import smtplib
+import tempfile
+
+from django.core import mail
+from django.test import TestCase
+
+from djembe import testing
+from djembe import testing_data as data
+from djembe import tls
+from djembe.backends import EncryptingSMTPBackend
+from djembe.tests.test_binary import Relay
+
+from M2Crypto import SSL
+
+
+class SessionResumptionTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.certfile = os.path.join(self.directory, 'relay.pem')
+        with open(self.certfile, 'w') as f:
+            f.write('\n'.join([data.RECIPIENT1_CERTIFICATE.strip(), data.RECIPIENT1_KEY.strip(), '']))
+        tls.session_cache.clear()
+        self.relay = None
+
+    def tearDown(self):
+        if self.relay is not None:
+            self.relay.stop()
+        shutil.rmtree(self.directory)
+
+    def start_relay(self, resumable=True, implicit_tls=False):
+        context = SSL.Context('tls')
+        context.load_cert_chain(self.certfile)
+        context.set_session_id_ctx('djembe-tests')
+        if not resumable:
+            context.set_session_cache_mode(0)
+            context.set_options(0x4000)  # SSL_OP_NO_TICKET
+        self.relay = Relay([], context, implicit_tls)
+
+    def connect(self, **kwargs):
+        """
+        Opens and closes a connection, returning whether it resumed a session.
+        """
+        backend = EncryptingSMTPBackend(host='127.0.0.1', port=self.relay.port, timeout=10, **kwargs)
+        self.assertTrue(backend.open())
+        self.assertTrue(isinstance(backend.connection, tls.SMTP))
+        reused = backend.tls_session_reused
+        # the relay answers over TLS
+        self.assertEqual(backend.connection.noop()[0], 250)
+        backend.close()
+        return reused
+
+    def testStartTLS(self):
+        self.start_relay()
+        with self.settings(DJEMBE_TLS_SESSION_CACHE=True):
+            self.assertEqual([self.connect(use_tls=True) for i in range(3)], [False, True, True])
+        self.assertEqual(tls.session_cache.stats(), {'connections': 3, 'resumed': 2, 'cached_sessions': 1})
+        self.assertEqual(self.relay.commands.count('STARTTLS'), 3)
+
+    def testSMTPS(self):
+        self.start_relay(implicit_tls=True)
+        with self.settings(DJEMBE_TLS_SESSION_CACHE=True):
+            self.assertEqual([self.connect(use_ssl=True) for i in range(2)], [False, True])
+
+    def testNotResumable(self):
+        self.start_relay(resumable=False)
+        with self.settings(DJEMBE_TLS_SESSION_CACHE=True):
+            self.assertEqual([self.connect(use_tls=True) for i in range(2)], [False, False])
+        self.assertEqual(tls.session_cache.stats()['resumed'], 0)
+
+    def testDelivery(self):
+        testing.load_fixture_identities()
+        self.start_relay()
+        with self.settings(DJEMBE_TLS_SESSION_CACHE=True):
+            for i in range(2):
+                backend = EncryptingSMTPBackend(host='127.0.0.1', port=self.relay.port, use_tls=True)
+                message = mail.EmailMessage('TLS', 'Resumed', 'recipient1@example.com', ['recipient2@example.com'])
+                self.assertEqual(backend.send_messages([message]), 1)
+        self.assertEqual(len(self.relay.messages), 2)
+        self.assertEqual(tls.session_cache.stats()['resumed'], 1)
+
+    def testDisabled(self):
+        self.start_relay()
+        backend = EncryptingSMTPBackend(host='127.0.0.1', port=self.relay.port, use_tls=True)
+        self.assertTrue(backend.connection_class is smtplib.SMTP)
+        with self.settings(DJEMBE_TLS_SESSION_CACHE=True):
+            self.assertTrue(backend.connection_class is tls.SMTP)
+            backend.use_tls = False
+            self.assertTrue(backend.connection_class is smtplib.SMTP)
@@ -0,0 +1,186 @@
+"""
+TLS session resumption for SMTP connections.
+
+Python 2's ssl module can't resume a TLS session, so when
+settings.DJEMBE_TLS_SESSION_CACHE is set, EncryptingSMTPBackend makes its
+STARTTLS and SMTPS connections with M2Crypto.SSL instead. Each process keeps
+one SSL context per client certificate and the last session negotiated with
+each relay, and offers that session on the next connection to the relay,
+which skips most of the handshake.
+
+As with smtplib's own TLS on Python 2, the relay's certificate isn't verified.
+"""
+import smtplib
+import socket
+import threading
+
+from M2Crypto import SSL
+from M2Crypto import m2
+from M2Crypto.SSL.Session import Session
+
+
+class SessionCache(object):
+    """
+    Remembers the last TLS session for each relay, and counts how many
+    connections resumed one.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.sessions = {}
+            self.connections = 0
+            self.resumed = 0
+
+    def get(self, key):
+        with self.lock:
+            return self.sessions.get(key)
+
+    def put(self, key, session):
+        with self.lock:
+            self.sessions[key] = session
+
+    def record(self, resumed):
+        with self.lock:
+            self.connections += 1
+            if resumed:
+                self.resumed += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'connections': self.connections,
+                'resumed': self.resumed,
+                'cached_sessions': len(self.sessions),
+            }
+
+
+session_cache = SessionCache()
+
+_contexts = {}
+_contexts_lock = threading.Lock()
+
+
+def get_context(keyfile=None, certfile=None):
+    """
+    Returns the shared SSL context for the given client certificate.
+    """
+    with _contexts_lock:
+        context = _contexts.get((keyfile, certfile))
+        if context is None:
+            context = SSL.Context('tls')
+            context.set_verify(SSL.verify_none, 0)
+            if certfile:
+                context.load_cert_chain(certfile, keyfile)
+            _contexts[(keyfile, certfile)] = context
+        return context
+
+
+class Connection(SSL.Connection):
+    """
+    A client TLS connection over an already connected socket, offering the
+    relay's last session. session_reused says whether it was resumed.
+    """
+
+    def __init__(self, sock, relay, keyfile=None, certfile=None, cache=session_cache):
+        # M2Crypto needs a blocking socket, and applies timeouts itself
+        timeout = sock.gettimeout()
+        sock.settimeout(None)
+        SSL.Connection.__init__(self, get_context(keyfile, certfile), sock=sock)
+        if timeout is not None:
+            self.set_socket_read_timeout(SSL.timeout(timeout))
+            self.set_socket_write_timeout(SSL.timeout(timeout))
+
+        self.cache = cache
+        self.key = relay + (keyfile, certfile)
+        offered = cache.get(self.key)
+
+        self.setup_ssl()
+        self.set_connect_state()
+        if offered is not None:
+            self.set_session(offered)
+        try:
+            self.connect_ssl()
+        except SSL.SSLError as e:
+            SSL.Connection.close(self, freeBio=True)
+            raise socket.error('TLS handshake with %s:%s failed: %s' % (relay + (e,)))
+
+        # a resumed handshake keeps the session it was offered
+        self.session_reused = (
+            offered is not None
+            and int(m2.ssl_get_session(self.ssl)) == int(offered._ptr())
+        )
+        cache.record(self.session_reused)
+        self.save_session()
+
+    def close(self):
+        # TLS 1.3 relays send their sessions after the handshake
+        if not self._bio_freed:
+            self.save_session()
+            SSL.Connection.close(self, freeBio=True)
+
+    def write(self, data):
+        # smtplib's commands may be unicode, which sockets take as ASCII
+        return SSL.Connection.write(self, str(data))
+    sendall = send = write
+
+    def save_session(self):
+        # get_session() doesn't take a reference, so its session would be
+        # freed along with the connection
+        session = m2.ssl_get1_session(self.ssl)
+        if session is not None:
+            self.cache.put(self.key, Session(session, 1))
+
+
+class SMTP(smtplib.SMTP):
+    """
+    smtplib.SMTP, but STARTTLS resumes the relay's last TLS session.
+    """
+
+    tls_connection = None
+
+    def __init__(self, host='', port=0, *args, **kwargs):
+        self.relay = (host, port)
+        smtplib.SMTP.__init__(self, host, port, *args, **kwargs)
+
+    def starttls(self, keyfile=None, certfile=None):
+        self.ehlo_or_helo_if_needed()
+        if not self.has_extn('starttls'):
+            raise smtplib.SMTPException('STARTTLS extension not supported by server.')
+        resp, reply = self.docmd('STARTTLS')
+        if resp != 220:
+            raise smtplib.SMTPResponseException(resp, reply)
+        self.sock = self.tls_connection = Connection(self.sock, self.relay, keyfile, certfile)
+        self.file = None
+        # RFC 3207: forget what the server said before TLS
+        self.helo_resp = None
+        self.ehlo_resp = None
+        self.esmtp_features = {}
+        self.does_esmtp = 0
+        return (resp, reply)
+
+    @property
+    def tls_session_reused(self):
+        return self.tls_connection is not None and self.tls_connection.session_reused
+
+
+class SMTP_SSL(SMTP):
+    """
+    smtplib.SMTP_SSL, but resuming the relay's last TLS session.
+    """
+
+    default_port = smtplib.SMTP_SSL_PORT
+
+    def __init__(self, host='', port=0, local_hostname=None, keyfile=None, certfile=None,
+                 timeout=socket._GLOBAL_DEFAULT_TIMEOUT):
+        self.keyfile = keyfile
+        self.certfile = certfile
+        SMTP.__init__(self, host, port, local_hostname, timeout)
+
+    def _get_socket(self, host, port, timeout):
+        sock = socket.create_connection((host, port), timeout)
+        self.tls_connection = Connection(sock, self.relay, self.keyfile, self.certfile)
+        return self.tls_connection
@@ -29,6 +29,8 @@ setup(
     name='django-djembe',
     packages=[
         'djembe',
+        'djembe.management',
+        'djembe.management.commands',
         'djembe.migrations',
         'djembe.tests'
     ],